@@ -1,21 +1,77 @@
 import requests
-import pickle
+import requests.adapters
+import urllib3.util
+import json
+import sqlite3
 import platform
 import argparse
 import chess
 import chess.engine
 import chess.svg
 import math
+import operator
 import sys
+import subprocess
 import concurrent.futures
 import multiprocessing
+import threading
+import queue
 import hashlib
 import cairosvg
-import graphviz
 from os.path import exists
 from urllib import parse
 
 
+class Cache:
+    """A dict-like cache of query results, persistent in an sqlite database.
+
+    Keys are stored by their repr() and values as JSON. Each update is
+    written to disk immediately, so an interrupted run keeps its results.
+    Entries written with a different format version are discarded.
+    """
+
+    version = 1
+
+    def __init__(self, filename, purge=False):
+        self.lock = threading.Lock()
+        self.memory = {}
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value TEXT)"
+            )
+            (version,) = self.db.execute("PRAGMA user_version").fetchone()
+            if purge or version != self.version:
+                self.db.execute("DELETE FROM cache")
+                self.db.execute("PRAGMA user_version = {}".format(self.version))
+
+    def get(self, key, default=None):
+        if key in self.memory:
+            return self.memory[key]
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM cache WHERE key = ?", (repr(key),)
+            ).fetchone()
+
+        if row is None:
+            return default
+
+        value = json.loads(row[0])
+        self.memory[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.memory[key] = value
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache(key, value) VALUES (?, ?)",
+                (repr(key), json.dumps(value, separators=(",", ":"))),
+            )
+
+
 class ChessGraph:
     def __init__(
         self,
@@ -29,6 +85,7 @@ class ChessGraph:
         enginemaxmoves,
         boardstyle,
         boardedges,
+        purgecache=False,
     ):
         self.networkstyle = networkstyle
         self.depth = depth
@@ -40,88 +97,133 @@ class ChessGraph:
         self.boardstyle = boardstyle
         self.boardedges = boardedges
 
-        self.executorgraph = [
-            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
-            for i in range(0, depth + 1)
-        ]
-        self.executorwork = concurrent.futures.ThreadPoolExecutor(
+        # children are only submitted while a worker is free to take them,
+        # since their parents block until they complete
+        self.executorgraph = concurrent.futures.ThreadPoolExecutor(
             max_workers=concurrency
         )
+        self.executorslots = threading.Semaphore(concurrency)
+        # bounds the number of concurrent requests / engines
+        self.worksemaphore = threading.Semaphore(concurrency)
         self.visited = set()
+        self.svgwritten = set()
+        self.nodenames = {}
+        self.nodenameslock = threading.Lock()
         self.session = requests.Session()
-        self.graph = graphviz.Digraph("ChessGraph", format="svg")
-        self.cache = {}
-
-        # We fix lichessbeta by giving the startpos a score of 0.35
+        # pool connections such that all threads can reuse one to the server
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=concurrency,
+            pool_maxsize=2 * concurrency,
+            max_retries=urllib3.util.Retry(
+                total=2, backoff_factor=0.2, status_forcelist=[429, 502, 503]
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.dotlines = []
+        self.cache = Cache("chessgraph.cache.db", purge=purgecache)
+        self.queried = {}
+        self.queriedlock = threading.Lock()
+        self.enginepool = queue.Queue()
+
+        # lichessbeta is only needed once moves are scored, so it is obtained
+        # while the first positions are queried
         if self.source == "lichess":
-            w, d, l, moves = self.lichess_api_call(
-                "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -"
-            )
-            self.lichessbeta = (1 - 0.35) / math.log((w + d + l) / w - 1)
+            self.executorslots.acquire()
+            self.lichessbeta = self.executorgraph.submit(self.get_lichessbeta)
+            self.lichessbeta.add_done_callback(lambda f: self.executorslots.release())
         else:
             self.lichessbeta = None
 
-    def load_cache(self):
-        try:
-            with open("chessgraph.cache.pyc", "rb") as f:
-                self.cache = pickle.load(f)
-        except:
-            self.cache = {}
-
-    def store_cache(self):
-        with open("chessgraph.cache.pyc", "wb") as f:
-            pickle.dump(self.cache, f)
+    def close(self):
+        self.executorgraph.shutdown()
+        while not self.enginepool.empty():
+            self.enginepool.get_nowait().quit()
 
     def get_moves(self, epd):
-        if self.source == "chessdb":
-            return self.get_moves_chessdb(epd)
-        elif self.source == "engine":
-            return self.get_moves_engine(epd)
-        elif self.source == "lichess":
-            return self.get_moves_lichess(epd)
-        else:
-            assert False
+        # each position is queried once per run, concurrent requests for the
+        # same position wait for the pending query
+        with self.queriedlock:
+            future = self.queried.get(epd)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self.queried[epd] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            with self.worksemaphore:
+                if self.source == "chessdb":
+                    stdmoves = self.get_moves_chessdb(epd)
+                elif self.source == "engine":
+                    stdmoves = self.get_moves_engine(epd)
+                elif self.source == "lichess":
+                    stdmoves = self.get_moves_lichess(epd)
+                else:
+                    assert False
+            # the cache holds uci strings, parse them once for all later visits
+            moves = [(score, chess.Move.from_uci(uci)) for score, uci in stdmoves]
+            if self.source != "chessdb":
+                moves.sort(key=operator.itemgetter(0), reverse=True)
+            future.set_result(moves)
+        except BaseException as e:
+            # allow a later visit to query again
+            with self.queriedlock:
+                del self.queried[epd]
+            future.set_exception(e)
+            raise
+
+        return moves
 
     def get_bestscore_and_moves(self, board):
-        if board.is_checkmate():
+        # generate the legal moves only once, for mate, stalemate and the count
+        legalMovesCount = board.legal_moves.count()
+        if legalMovesCount == 0 and board.is_check():
             moves = []
             bestscore = -30000
         elif (
-            board.is_stalemate()
+            legalMovesCount == 0
             or board.is_insufficient_material()
             or board.can_claim_draw()
         ):
             moves = []
             bestscore = 0
         else:
-            moves = self.executorwork.submit(self.get_moves, board.epd()).result()
-            if self.source != "chessdb":
-                moves.sort(key=lambda item: item["score"], reverse=True)
-            bestscore = int(moves[0]["score"]) if moves else None
-        return bestscore, moves
+            moves = self.get_moves(board.epd())
+            bestscore = int(moves[0][0]) if moves else None
+        return bestscore, moves, legalMovesCount
 
     def get_moves_engine(self, epd):
         key = (epd, self.engine, self.enginedepth, self.enginemaxmoves)
 
-        if key in self.cache:
-            return self.cache[key]
+        moves = self.cache.get(key)
+        if moves is not None:
+            return moves
 
         moves = []
-        engine = chess.engine.SimpleEngine.popen_uci(self.engine)
+        try:
+            engine = self.enginepool.get_nowait()
+        except queue.Empty:
+            engine = chess.engine.SimpleEngine.popen_uci(self.engine)
         board = chess.Board(epd)
+        # a new game for each position, so that results do not depend on
+        # what the engine analysed before
         info = engine.analyse(
             board,
             chess.engine.Limit(depth=self.enginedepth),
             multipv=self.enginemaxmoves,
+            game=epd,
             info=chess.engine.INFO_SCORE | chess.engine.INFO_PV,
         )
-        engine.quit()
+        self.enginepool.put(engine)
         for i in info:
             moves.append(
-                {
-                    "score": i["score"].pov(board.turn).score(mate_score=30000),
-                    "uci": chess.Move.uci(i["pv"][0]),
-                }
+                (
+                    i["score"].pov(board.turn).score(mate_score=30000),
+                    chess.Move.uci(i["pv"][0]),
+                )
             )
 
         self.cache[key] = moves
@@ -131,13 +233,12 @@ class ChessGraph:
     def get_moves_chessdb(self, epd):
         key = (epd, "chessdb")
 
-        if key in self.cache:
-            stdmoves = self.cache[key]
-            if len(stdmoves) > 0:
-                return stdmoves
+        stdmoves = self.cache.get(key)
+        if stdmoves:
+            return stdmoves
 
         api = "http://www.chessdb.cn/cdb.php"
-        url = api + "?action=queryall&board=" + parse.quote(epd) + "&json=1"
+        url = f"{api}?action=queryall&board={parse.quote(epd)}&json=1"
         timeout = 3
 
         moves = []
@@ -158,14 +259,32 @@ class ChessGraph:
 
         stdmoves = []
         for m in moves:
-            stdmoves.append({"score": m["score"], "uci": m["uci"]})
+            stdmoves.append((m["score"], m["uci"]))
 
         self.cache[key] = stdmoves
 
         return stdmoves
 
+    def get_lichessbeta(self):
+        key = ("lichessbeta", self.lichessdb)
+
+        lichessbeta = self.cache.get(key)
+        if lichessbeta is not None:
+            return lichessbeta
+
+        # We fix lichessbeta by giving the startpos a score of 0.35
+        w, d, l, moves = self.lichess_api_call(
+            "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -"
+        )
+        lichessbeta = (1 - 0.35) / math.log((w + d + l) / w - 1)
+
+        self.cache[key] = lichessbeta
+
+        return lichessbeta
+
     def lichess_wdl_to_score(self, w, d, l):
         total = w + d + l
+        lichessbeta = self.lichessbeta.result()
 
         if w == l:
             return 0.0
@@ -177,13 +296,9 @@ class ChessGraph:
             return -10000
 
         if w > l:
-            return min(
-                10000, int(100 - 100 * self.lichessbeta * math.log(total / w - 1))
-            )
+            return min(10000, int(100 - 100 * lichessbeta * math.log(total / w - 1)))
         else:
-            return max(
-                -10000, -int(100 - 100 * self.lichessbeta * math.log(total / l - 1))
-            )
+            return max(-10000, -int(100 - 100 * lichessbeta * math.log(total / l - 1)))
 
     def lichess_api_call(self, epd):
         if self.lichessdb == "masters":
@@ -197,10 +312,8 @@ class ChessGraph:
             )
 
         url = (
-            "https://explorer.lichess.ovh/{}?".format(self.lichessdb)
-            + specifics
-            + "&moves={}".format(self.enginemaxmoves)
-            + "&fen={}".format(parse.quote(epd))
+            f"https://explorer.lichess.ovh/{self.lichessdb}?{specifics}"
+            f"&moves={self.enginemaxmoves}&fen={parse.quote(epd)}"
         )
 
         timeout = 3
@@ -224,10 +337,9 @@ class ChessGraph:
     def get_moves_lichess(self, epd):
         key = (epd, "lichess", self.enginemaxmoves, self.lichessdb)
 
-        if key in self.cache:
-            stdmoves = self.cache[key]
-            if len(stdmoves) > 0:
-                return stdmoves
+        stdmoves = self.cache.get(key)
+        if stdmoves:
+            return stdmoves
 
         w, d, l, moves = self.lichess_api_call(epd)
 
@@ -242,55 +354,65 @@ class ChessGraph:
             lichessmingames = 10
             if total > lichessmingames:
                 score = self.lichess_wdl_to_score(w, d, l)
-                stdmoves.append({"score": score, "uci": m["uci"]})
+                stdmoves.append((score, m["uci"]))
 
         self.cache[key] = stdmoves
 
         return stdmoves
 
-    def node_name(self, board):
+    def node_key(self, board):
         if self.networkstyle == "graph":
-            name = "graph - " + board.epd()
+            key = board._transposition_key()
         elif self.networkstyle == "tree":
-            movelist = []
-            while True:
-                try:
-                    move = board.pop()
-                    movelist.append(move)
-                except:
-                    break
-            name = board.epd() + " moves "
-            for move in reversed(movelist):
-                board.push(move)
-                name = name + " " + move.uci()
+            # all lines start from the same root, so the moves identify the node
+            key = tuple(board.move_stack)
         else:
             raise ()
 
+        return key
+
+    def node_name(self, key):
+        # short graphviz ids, the epd of the node is shown in its tooltip
+        with self.nodenameslock:
+            name = self.nodenames.get(key)
+            if name is None:
+                name = "n{:x}".format(len(self.nodenames))
+                self.nodenames[key] = name
+
         return name
 
-    def write_node(self, board, score, showboard, pvNode, tooltip):
+    def write_dot(self, statement, **attrs):
+        # list.append is atomic, so threads can write concurrently
+        attributes = " ".join(
+            '{}="{}"'.format(name, value.replace('"', '\\"'))
+            for name, value in attrs.items()
+        )
+        self.dotlines.append("\t{} [{}]".format(statement, attributes))
+
+    def dot_source(self):
+        return "digraph ChessGraph {{\n{}\n}}\n".format("\n".join(self.dotlines))
+
+    def write_node(self, board, nodename, score, showboard, pvNode, tooltip):
         epd = board.epd()
-        nodename = self.node_name(board)
 
         color = "gold" if board.turn == chess.WHITE else "burlywood4"
         penwidth = "3" if pvNode else "1"
 
         epdweb = parse.quote(epd)
-        URL = "https://www.chessdb.cn/queryc_en/?" + epdweb
+        URL = f"https://www.chessdb.cn/queryc_en/?{epdweb}"
         image = None
 
         if showboard and not self.boardstyle == "none":
             if self.boardstyle == "unicode":
                 label = board.unicode(empty_square="\u00B7")
             elif self.boardstyle == "svg":
-                filename = (
-                    "node-" + hashlib.sha256(epd.encode("utf-8")).hexdigest() + ".svg"
-                )
-                if not exists(filename):
-                    cairosvg.svg2svg(
-                        bytestring=chess.svg.board(board, size="200px").encode("utf-8"),
-                        write_to=filename,
-                    )
+                digest = hashlib.blake2b(epd.encode("utf-8"), digest_size=16)
+                filename = f"node-{digest.hexdigest()}.svg"
+                if filename not in self.svgwritten:
+                    if not exists(filename):
+                        with open(filename, "w", encoding="utf-8") as f:
+                            f.write(chess.svg.board(board, size="200px"))
+                    self.svgwritten.add(filename)
                 image = filename
                 label = ""
         else:
@@ -301,7 +423,7 @@ class ChessGraph:
             )
 
         if image:
-            self.graph.node(
+            self.write_dot(
                 nodename,
                 label=label,
                 shape="box",
@@ -312,7 +434,7 @@ class ChessGraph:
                 tooltip=tooltip,
             )
         else:
-            self.graph.node(
+            self.write_dot(
                 nodename,
                 label=label,
                 shape="box",
@@ -336,9 +458,8 @@ class ChessGraph:
             "None" if score is None else str(score if turn == chess.WHITE else -score),
         )
         tooltip = labeltooltip
-        self.graph.edge(
-            nodefrom,
-            nodeto,
+        self.write_dot(
+            "{} -> {}".format(nodefrom, nodeto),
             label=sanmove,
             color=color,
             penwidth=penwidth,
@@ -350,103 +471,118 @@ class ChessGraph:
         )
 
     def recurse(self, board, depth, alpha, beta, pvNode, plyFromRoot):
-        nodenamefrom = self.node_name(board)
+        keyfrom = self.node_key(board)
 
         # terminate recursion if visited
-        if nodenamefrom in self.visited:
+        if keyfrom in self.visited:
             return
         else:
-            self.visited.add(nodenamefrom)
+            self.visited.add(keyfrom)
 
-        bestscore, moves = self.get_bestscore_and_moves(board)
+        nodenamefrom = self.node_name(keyfrom)
+
+        bestscore, moves, legalMovesCount = self.get_bestscore_and_moves(board)
 
         edgesfound = 0
         edgesdrawn = 0
         futures = []
         turn = board.turn
-        tooltip = board.epd() + "&#010;"
+        tooltip = [board.epd() + "&#010;"]
 
         # loop through the (sorted) moves that are within delta of the bestmove
-        for m in moves:
-            score = int(m["score"])
+        for score, move in moves:
+            score = int(score)
 
             if score <= alpha:
                 break
 
-            ucimove = m["uci"]
-            move = chess.Move.from_uci(ucimove)
-            sanmove = board.san(move)
-            board.push(move)
-            nodenameto = self.node_name(board)
             edgesfound += 1
             pvEdge = pvNode and score == bestscore
             lateEdge = score != bestscore
 
-            # no loops, otherwise recurse
             if score == bestscore:
                 newDepth = depth - 1
             else:
-                newDepth = depth - int(1.5 + math.log2(edgesfound))
-
-            if newDepth >= 0:
-                if nodenameto not in self.visited:
-                    futures.append(
-                        self.executorgraph[depth].submit(
-                            self.recurse,
-                            board.copy(),
-                            newDepth,
-                            -beta,
-                            -alpha,
-                            pvEdge,
-                            plyFromRoot + 1,
-                        )
-                    )
-                edgesdrawn += 1
-                tooltip += "{} : {}&#010;".format(
-                    sanmove, str(score if turn == chess.WHITE else -score)
-                )
-                self.write_edge(
-                    nodenamefrom,
-                    nodenameto,
-                    sanmove,
-                    ucimove,
-                    turn,
-                    score,
+                # int(1.5 + log2(edgesfound)), evaluated exactly in integers
+                newDepth = depth - 1 - (edgesfound * edgesfound).bit_length() // 2
+
+            # edges beyond the depth are not drawn, skip them before any board work
+            if newDepth < 0:
+                continue
+
+            sanmove = board.san(move)
+            board.push(move)
+            keyto = self.node_key(board)
+
+            # no loops, otherwise recurse
+            if keyto not in self.visited:
+                args = (
+                    board.copy(),
+                    newDepth,
+                    -beta,
+                    -alpha,
                     pvEdge,
-                    lateEdge,
+                    plyFromRoot + 1,
+                )
+                if self.executorslots.acquire(blocking=False):
+                    future = self.executorgraph.submit(self.recurse, *args)
+                    future.add_done_callback(lambda f: self.executorslots.release())
+                    futures.append(future)
+                else:
+                    self.recurse(*args)
+            edgesdrawn += 1
+            tooltip.append(
+                "{} : {}&#010;".format(
+                    sanmove, str(score if turn == chess.WHITE else -score)
                 )
+            )
+            self.write_edge(
+                nodenamefrom,
+                self.node_name(keyto),
+                sanmove,
+                move.uci(),
+                turn,
+                score,
+                pvEdge,
+                lateEdge,
+            )
 
             board.pop()
 
         concurrent.futures.wait(futures)
 
-        remainingMoves = board.legal_moves.count() - edgesdrawn
-        tooltip += "{} remaining {}&#010;".format(
-            remainingMoves, "move" if remainingMoves == 1 else "moves"
+        remainingMoves = legalMovesCount - edgesdrawn
+        tooltip.append(
+            "{} remaining {}&#010;".format(
+                remainingMoves, "move" if remainingMoves == 1 else "moves"
+            )
         )
 
         if edgesdrawn == 0:
-            tooltip += "terminal: {}".format(
-                "None"
-                if bestscore is None
-                else str(bestscore if turn == chess.WHITE else -bestscore)
+            tooltip.append(
+                "terminal: {}".format(
+                    "None"
+                    if bestscore is None
+                    else str(bestscore if turn == chess.WHITE else -bestscore)
+                )
             )
 
         self.write_node(
             board,
+            nodenamefrom,
             bestscore,
             edgesdrawn >= self.boardedges
             or (pvNode and edgesdrawn == 0)
             or plyFromRoot == 0,
             pvNode,
-            tooltip,
+            "".join(tooltip),
         )
 
     def generate_graph(self, epd, alpha, beta, ralpha, rbeta, salpha, sbeta):
         # set initial board
         board = chess.Board(epd)
 
-        score, _ = self.get_bestscore_and_moves(board)
+        score, _, _ = self.get_bestscore_and_moves(board)
         score = score if board.turn == chess.WHITE else -score
 
         if ralpha is not None:
@@ -628,7 +764,7 @@ if __name__ == "__main__":
         "--purgecache",
         action=argparse.BooleanOptionalAction,
         default=False,
-        help="Do no use, and later overwrite, the cache file stored on disk (chessgraph.cache.pyc).",
+        help="Do no use, and later overwrite, the cache file stored on disk (chessgraph.cache.db).",
     )
 
     args = parser.parse_args()
@@ -644,12 +780,9 @@ if __name__ == "__main__":
         enginemaxmoves=args.enginemaxmoves,
         boardstyle=args.boardstyle,
         boardedges=args.boardedges,
+        purgecache=args.purgecache,
     )
 
-    # load previously computed nodes in a cache
-    if not args.purgecache:
-        chessgraph.load_cache()
-
     if args.san is not None:
         import chess.pgn, io
 
@@ -666,11 +799,16 @@ if __name__ == "__main__":
         fen, args.alpha, args.beta, args.ralpha, args.rbeta, args.salpha, args.sbeta
     )
 
-    # store updated cache
-    chessgraph.store_cache()
+    # stop the worker threads and the engines started for the analysis
+    chessgraph.close()
 
     # generate the svg image (calls graphviz under the hood)
-    svgpiped = chessgraph.graph.pipe()
+    svgpiped = subprocess.run(
+        ["dot", "-Tsvg"],
+        input=chessgraph.dot_source().encode("utf-8"),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
 
     if args.embed:
         # this embeds the images of the boards generated.